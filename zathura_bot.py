@@ -1,170 +1,653 @@
-# --- Imports ---
-import os
-import requests
-import json
-import logging
-from flask import Flask, request, jsonify
-import sys
-import threading
-
-# --- Configuration and Constants ---
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
-WEBHOOK_URL = os.getenv("WEBHOOK_URL")
-
-# Telegram API URL
-TELEGRAM_API_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/"
-
-# Gemini API URLs
-GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta/models"
-GEMINI_TEXT_MODEL = "gemini-2.5-flash-preview-09-2025"
-
-# Logging setup
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-# Flask App Initialization
-app = Flask(__name__)
-
-# --- AI Core Functions ---
-
-def generate_gemini_response(prompt: str) -> str:
-    """Sends a text prompt to Gemini and returns the response, with search grounding."""
-    if not GEMINI_API_KEY:
-        return "Error: Gemini API Key not configured."
-
-    url = f"{GEMINI_API_BASE}/{GEMINI_TEXT_MODEL}:generateContent?key={GEMINI_API_KEY}"
-    
-    system_prompt = "You are Zathura Companion, an intelligent AI assistant. Respond concisely and professionally. If the request requires up-to-date knowledge or real-time information, use Google Search grounding."
-    
-    payload = {
-        "contents": [{"parts": [{"text": prompt}]}],
-        "tools": [{"google_search": {}}],
-        "systemInstruction": {"parts": [{"text": system_prompt}]}
-    }
-
-    headers = {'Content-Type': 'application/json'}
-    
-    try:
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()
-        
-        result = response.json()
-        candidate = result.get('candidates', [{}])[0]
-        
-        if candidate and candidate.get('content') and candidate['content'].get('parts'):
-            text = candidate['content']['parts'][0].get('text', "Could not generate a textual response.")
-            
-            return text
-        else:
-            return "Error: Received an empty or unexpected response from the Gemini API."
-
-    except requests.exceptions.HTTPError as e:
-        logger.error(f"HTTP Error: {e.response.status_code} - {e.response.text}")
-        return f"An HTTP error occurred: {e.response.status_code}. Please check the server logs."
-    except Exception as e:
-        logger.error(f"General Error generating response: {e}")
-        return "An unknown error occurred while generating the response."
-
-# --- Telegram Helper ---
-
-def send_telegram_message(chat_id, text, parse_mode="MarkdownV2"):
-    """Sends a message back to Telegram."""
-    send_url = f"{TELEGRAM_API_URL}sendMessage"
-    payload = {
-        "chat_id": chat_id,
-        "text": text,
-        "parse_mode": parse_mode,
-        "disable_web_page_preview": True
-    }
-    requests.post(send_url, json=payload)
-
-# --- Asynchronous Logic Processor ---
-
-def process_ai_request(chat_id, text):
-    """Processes the message payload in a separate thread."""
-    try:
-        # 1. Send "Thinking..." acknowledgment
-        send_telegram_message(chat_id, "Thinking...")
-        
-        # 2. Generate and send final response
-        response_text = generate_gemini_response(text)
-        send_telegram_message(chat_id, response_text)
-
-    except Exception as e:
-        logger.error(f"Error processing AI request: {e}")
-
-# --- Flask Webhook Route ---
-
-@app.route('/')
-def hello():
-    # Simple check to confirm service is awake
-    return "Zathura Companion Bot is running."
-
-@app.route('/webhook', methods=['POST'])
-def webhook_handler():
-    if not BOT_TOKEN:
-        return jsonify({'status': 'BOT_TOKEN not configured'}), 503
-
-    try:
-        update = request.get_json()
-        
-        if not update or 'message' not in update:
-            return jsonify({'status': 'No message in update'}), 200
-
-        message = update['message']
-        chat_id = message['chat']['id']
-        text = message.get('text', '')
-
-        if not text:
-            return jsonify({'status': 'No text in message'}), 200
-
-        # --- CRITICAL START FIX ---
-        if text.startswith('/start'):
-            welcome_message = (
-                "🛰️ *Welcome to Zathura Companion!* (Flask Stable)\n\n"
-                "I am your text-based AI assistant. I can answer any question you have.\n\n"
-                "*Python System Info:* " + sys.version.split()[0] + "\n\n"
-                "**🤖 To Ask Me a Question:**\n"
-                "Just send your message as plain text."
-            )
-            # Send welcome message synchronously and instantly, before returning 200 OK
-            send_telegram_message(chat_id, welcome_message)
-            return jsonify({'status': 'ok', 'message': '/start processed'}), 200
-        # --- END CRITICAL START FIX ---
-        
-        # Text Handling (AI processing handled asynchronously)
-        else:
-            # Launch the heavy AI processing in a new thread immediately.
-            threading.Thread(target=process_ai_request, args=(chat_id, text)).start()
-        
-        return jsonify({'status': 'ok', 'message': 'Processing started'}), 200
-
-    except Exception as e:
-        logger.error(f"Error receiving webhook: {e}")
-        return jsonify({'status': 'error'}), 500
-
-# --- Deployment Setup ---
-
-def set_telegram_webhook():
-    """Sets the Telegram webhook URL."""
-    if not WEBHOOK_URL or not BOT_TOKEN:
-        logger.error("WEBHOOK_URL or BOT_TOKEN not set for webhook.")
-        return
-
-    webhook_url = f"{TELEGRAM_API_URL}setWebhook"
-    payload = {"url": f"{WEBHOOK_URL}/webhook"}
-    
-    response = requests.post(webhook_url, json=payload)
-    logger.info(f"SetWebhook response: {response.status_code} - {response.text}")
-    
-    if response.status_code != 200:
-        logger.error(f"Failed to set webhook: {response.text}")
-
-if __name__ == '__main__':
-    # Set the webhook URL when the bot starts
-    set_telegram_webhook()
-    
-    # Render uses the PORT environment variable
-    port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
+# --- Imports ---
+import atexit
+import os
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import logging
+import orjson
+import queue
+import re
+import time
+from functools import lru_cache
+from collections import OrderedDict
+from hashlib import sha256
+from concurrent.futures import Future, ThreadPoolExecutor
+from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import HTTPException
+import sys
+import threading
+
+# --- Configuration and Constants ---
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+
+# Credentials cannot change at runtime, so fail fast at boot instead of
+# wasting a network round-trip per update on a misconfigured key.
+if not BOT_TOKEN:
+    raise RuntimeError("BOT_TOKEN environment variable is not set.")
+if not GEMINI_API_KEY:
+    raise RuntimeError("GEMINI_API_KEY environment variable is not set.")
+
+# Flipped to False when the boot-time key check gets a definitive auth
+# rejection, so AI calls short-circuit instead of re-failing upstream.
+GEMINI_HEALTHY = True
+
+# Telegram API URLs, frozen once instead of rebuilt per call
+TELEGRAM_API_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/"
+SEND_MESSAGE_URL = TELEGRAM_API_URL + "sendMessage"
+SEND_CHAT_ACTION_URL = TELEGRAM_API_URL + "sendChatAction"
+SET_WEBHOOK_URL = TELEGRAM_API_URL + "setWebhook"
+
+# Gemini API URLs
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta/models"
+GEMINI_TEXT_MODEL = "gemini-2.5-flash-preview-09-2025"
+GEMINI_URL = f"{GEMINI_API_BASE}/{GEMINI_TEXT_MODEL}:generateContent"
+# Key goes in the query params, not baked into the URL string.
+GEMINI_PARAMS = {"key": GEMINI_API_KEY}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'}
+
+# Upper bound on a Gemini reply body; anything larger is refused rather
+# than parsed (grounded replies run tens of KB, never MBs).
+GEMINI_MAX_RESPONSE_BYTES = 1_000_000
+
+# Logging setup
+# Epoch timestamps skip strftime, and production defaults to WARNING so the
+# hot path does no INFO formatting or I/O; override with LOG_LEVEL locally.
+logging.basicConfig(format='%(created).0f - %(name)s - %(levelname)s - %(message)s',
+                    level=os.getenv("LOG_LEVEL", "WARNING"))
+logger = logging.getLogger(__name__)
+
+# Flask App Initialization
+app = Flask(__name__)
+# Telegram updates are a few KB; reject anything bigger with a 413 before
+# the body is even read.
+app.config["MAX_CONTENT_LENGTH"] = 1 << 20
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Routes Flask's jsonify/json handling through orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app.json = ORJSONProvider(app)
+
+# The overwhelmingly common webhook response, pre-serialized so the ack
+# paths do no JSON work at all.
+OK_RESPONSE = (b'{"status": "ok"}', 200, {"Content-Type": "application/json"})
+
+# --- HTTP Sessions ---
+# Persistent sessions with keep-alive pooling so each Telegram/Gemini call
+# reuses an existing TLS connection instead of paying a fresh handshake.
+def _build_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=2,
+            backoff_factor=0.2,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+        ),
+    )
+    session.mount("https://", adapter)
+    return session
+
+TG_SESSION = _build_session()
+
+# Gemini supports HTTP/2, so its client multiplexes concurrent calls over one
+# connection and reuses TLS sessions across reconnects; Telegram stays on the
+# pooled requests session above.
+GEMINI_CLIENT = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=85),
+    timeout=httpx.Timeout(15.0, connect=3.0),
+    transport=httpx.HTTPTransport(retries=2),
+)
+
+# Persistent worker pool for background sends and AI processing, instead of
+# spawning a fresh thread per update.
+EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+def _close_clients():
+    """Gracefully closes pooled connections on worker shutdown."""
+    GEMINI_CLIENT.close()
+    TG_SESSION.close()
+
+atexit.register(_close_clients)
+
+# --- Response Cache ---
+# Exact-match LRU+TTL cache so repeated prompts (FAQ-style questions,
+# duplicate Telegram deliveries) skip the paid Gemini round-trip entirely.
+SYSTEM_PROMPT = "You are Zathura Companion, an intelligent AI assistant. Respond concisely and professionally. If the request requires up-to-date knowledge or real-time information, use Google Search grounding."
+
+# Constant payload fragments, built once instead of per call.
+SYSTEM_INSTRUCTION = {"parts": [{"text": SYSTEM_PROMPT}]}
+TOOLS = [{"google_search": {}}]
+
+# /start welcome, built (and MarkdownV2-escaped) once at import instead of
+# per command — the unescaped '!', '.', '(' etc. previously made Telegram
+# reject the message outright.
+_PY_VER = sys.version.split()[0].replace(".", "\\.")
+WELCOME_TEXT = (
+    "🛰️ *Welcome to Zathura Companion\\!* \\(Flask Stable\\)\n\n"
+    "I am your text\\-based AI assistant\\. I can answer any question you have\\.\n\n"
+    f"*Python System Info:* {_PY_VER}\n\n"
+    "*🤖 To Ask Me a Question:*\n"
+    "Just send your message as plain text\\."
+)
+
+CACHE_TTL = 3600
+CACHE_MAX = 500
+_RESPONSE_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+def _cache_key(prompt):
+    """Cache key bound to the model and system prompt, so a config change invalidates old entries."""
+    return sha256(f"{GEMINI_TEXT_MODEL}\0{SYSTEM_PROMPT}\0{prompt}".encode()).digest()
+
+def _cache_get(key):
+    with _CACHE_LOCK:
+        entry = _RESPONSE_CACHE.get(key)
+        if entry is None:
+            return None
+        expires_at, text = entry
+        if time.time() >= expires_at:
+            del _RESPONSE_CACHE[key]
+            return None
+        _RESPONSE_CACHE.move_to_end(key)
+        return text
+
+def _cache_put(key, text):
+    with _CACHE_LOCK:
+        _RESPONSE_CACHE[key] = (time.time() + CACHE_TTL, text)
+        _RESPONSE_CACHE.move_to_end(key)
+        while len(_RESPONSE_CACHE) > CACHE_MAX:
+            _RESPONSE_CACHE.popitem(last=False)
+
+# --- Semantic Cache (optional) ---
+# Near-duplicate prompts ("capital of France" vs "France's capital") share a
+# cached answer when their embedding cosine similarity clears the threshold.
+# Needs numpy + sentence-transformers; stays disabled on the slim deployment
+# when those are not installed.
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    np = None
+    SentenceTransformer = None
+
+class SemanticCache:
+    """Embedding-similarity cache over (prompt, response) pairs."""
+
+    EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+    def __init__(self, threshold=0.92, ttl=CACHE_TTL, max_entries=1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = SentenceTransformer is not None
+        self._lock = threading.Lock()
+        self._model = None
+        self._embeddings = None   # np.ndarray[N, dim], rows normalized
+        self._entries = []        # parallel list of (prompt, response, expires_at)
+
+    def embed(self, prompt):
+        """Returns the normalized embedding for prompt, or None when disabled."""
+        if not self.enabled:
+            return None
+        try:
+            if self._model is None:
+                self._model = SentenceTransformer(self.EMBED_MODEL)
+            vec = np.asarray(self._model.encode(prompt), dtype=np.float32)
+            norm = np.linalg.norm(vec)
+            return vec / norm if norm else vec
+        except Exception as e:
+            logger.error("Semantic cache embedding failed, disabling: %s", e)
+            self.enabled = False
+            return None
+
+    def get(self, query_vec):
+        if query_vec is None:
+            return None
+        with self._lock:
+            if not self._entries:
+                return None
+            sims = self._embeddings @ query_vec
+            best = int(sims.argmax())
+            _, response, expires_at = self._entries[best]
+            if sims[best] >= self.threshold and time.time() < expires_at:
+                return response
+            return None
+
+    def put(self, query_vec, prompt, response):
+        if query_vec is None:
+            return
+        with self._lock:
+            self._entries.append((prompt, response, time.time() + self.ttl))
+            if self._embeddings is None:
+                self._embeddings = query_vec.reshape(1, -1)
+            else:
+                self._embeddings = np.vstack((self._embeddings, query_vec))
+            if len(self._entries) > self.max_entries:
+                self._entries.pop(0)
+                self._embeddings = self._embeddings[1:]
+
+SEMANTIC_CACHE = SemanticCache()
+
+# --- Gemini Context Cache ---
+# The fixed system prompt and tools can be registered server-side once via
+# the cachedContents API and referenced per call, so their tokens aren't
+# re-sent and re-prefilled on every request. The API enforces a minimum
+# cached token count, so creation may be refused — in that case requests
+# keep the inline systemInstruction.
+GEMINI_CACHED_CONTENTS_URL = "https://generativelanguage.googleapis.com/v1beta/cachedContents"
+CONTEXT_CACHE_TTL = 3600
+
+_context_cache_name = None
+_context_cache_lock = threading.Lock()
+
+def _create_context_cache():
+    payload = {
+        "model": f"models/{GEMINI_TEXT_MODEL}",
+        "systemInstruction": SYSTEM_INSTRUCTION,
+        "tools": TOOLS,
+        "ttl": f"{CONTEXT_CACHE_TTL}s",
+    }
+    response = GEMINI_CLIENT.post(GEMINI_CACHED_CONTENTS_URL, params=GEMINI_PARAMS,
+                                  headers=JSON_HEADERS, content=orjson.dumps(payload))
+    response.raise_for_status()
+    return orjson.loads(response.content).get("name")
+
+def _context_cache_refresher():
+    """Creates the server-side cache at boot and re-creates it before each TTL expiry."""
+    global _context_cache_name
+    while True:
+        try:
+            name = _create_context_cache()
+        except Exception as e:
+            logger.warning("Context cache unavailable, sending inline system prompt: %s", e)
+            name = None
+        with _context_cache_lock:
+            _context_cache_name = name
+        # Refresh comfortably ahead of expiry.
+        time.sleep(CONTEXT_CACHE_TTL - 300)
+
+threading.Thread(target=_context_cache_refresher, daemon=True).start()
+
+def _get_context_cache_name():
+    with _context_cache_lock:
+        return _context_cache_name
+
+# --- Circuit Breaker ---
+# Fail fast while Gemini is degraded instead of pinning workers on timeouts
+# that Telegram then amplifies by retrying the same update.
+class Breaker:
+    """Opens after consecutive failures; rejects calls until the cool-down passes."""
+
+    def __init__(self, threshold=5, cool_down=30):
+        self.threshold = threshold
+        self.cool_down = cool_down
+        self._lock = threading.Lock()
+        self._fails = 0
+        self._open_until = 0.0
+
+    def is_open(self):
+        with self._lock:
+            return time.time() < self._open_until
+
+    def record_failure(self):
+        with self._lock:
+            self._fails += 1
+            if self._fails >= self.threshold:
+                self._open_until = time.time() + self.cool_down
+                self._fails = 0
+
+    def record_success(self):
+        with self._lock:
+            self._fails = 0
+
+GEMINI_BREAKER = Breaker()
+
+# Bounds concurrent upstream Gemini calls so a group-chat burst can't fan
+# out into rate-limit (429) territory; excess callers queue on the semaphore
+# while the webhook keeps acking instantly.
+GEMINI_SEM = threading.Semaphore(8)
+
+# --- Request Coalescer ---
+# generateContent treats multiple `contents` entries as turns of a single
+# conversation, so stacking unrelated users' prompts into one call would
+# merge their questions. The safe version of batching here is coalescing:
+# identical prompts arriving while one is already in flight share that
+# call's result instead of issuing their own.
+class GeminiBatcher:
+    """Collapses concurrent identical prompts into one upstream Gemini call."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def submit(self, prompt, fetch):
+        with self._lock:
+            existing = self._inflight.get(prompt)
+            if existing is None:
+                fut = Future()
+                self._inflight[prompt] = fut
+        if existing is not None:
+            # A leader is already fetching this prompt; wait for it outside
+            # the lock so unrelated prompts aren't serialized behind it.
+            return existing.result()
+        try:
+            result = fetch(prompt)
+            fut.set_result(result)
+            return result
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(prompt, None)
+
+BATCHER = GeminiBatcher()
+
+# Recently seen Telegram update_ids, so retry storms don't trigger
+# duplicate AI processing.
+_SEEN_UPDATES = OrderedDict()
+_SEEN_UPDATES_MAX = 1000
+
+def _is_duplicate_update(update_id):
+    if update_id is None:
+        return False
+    with _CACHE_LOCK:
+        if update_id in _SEEN_UPDATES:
+            return True
+        _SEEN_UPDATES[update_id] = None
+        while len(_SEEN_UPDATES) > _SEEN_UPDATES_MAX:
+            _SEEN_UPDATES.popitem(last=False)
+        return False
+
+# --- Input Preflight ---
+# Trivial inputs are answered directly instead of spending a Gemini call.
+# The greeting pattern only matches messages that are *just* a greeting, so
+# "hi, how do I…" still reaches the model.
+_GREETING_RE = re.compile(r"^(hi|hello|hey|thanks|thank you)\b[\s!.?]*$", re.IGNORECASE)
+MAX_PROMPT_CHARS = 4000
+TOO_SHORT_REPLY = "Please ask a longer question\\."
+GREETING_REPLY = "👋 Hello\\! Ask me anything and I'll do my best to help\\."
+
+@lru_cache(maxsize=512)
+def escape_md_v2(s: str) -> str:
+    """MarkdownV2-escapes text; memoized so repeated (cached) responses skip the regex pass."""
+    return re.sub(r"([_*\[\]()~`>#+=|{}.!\\-])", r"\\\1", s)
+
+# --- AI Core Functions ---
+
+def generate_gemini_response(prompt: str, use_cache: bool = True) -> str:
+    """Sends a text prompt to Gemini and returns the response, with search grounding."""
+    return BATCHER.submit(prompt, lambda p: _generate_gemini_response(p, use_cache))
+
+def _generate_gemini_response(prompt: str, use_cache: bool = True) -> str:
+    """Does the actual cache lookup + Gemini call for a single prompt."""
+    if not GEMINI_HEALTHY:
+        return "Error: Gemini API Key was rejected\\. Please check the server configuration\\."
+
+    cache_key = _cache_key(prompt)
+    if use_cache:
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+    # Exact-match missed (or bypassed); the embedding is still computed so a
+    # fresh answer can refresh the semantic tier below.
+    query_vec = SEMANTIC_CACHE.embed(prompt)
+    if use_cache:
+        cached = SEMANTIC_CACHE.get(query_vec)
+        if cached is not None:
+            return cached
+
+    if GEMINI_BREAKER.is_open():
+        return "AI temporarily unavailable\\. Please try again in a moment\\."
+
+    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    cached_content = _get_context_cache_name()
+    if cached_content:
+        # System prompt + tools live server-side; just reference them.
+        payload["cachedContent"] = cached_content
+    else:
+        payload["tools"] = TOOLS
+        payload["systemInstruction"] = SYSTEM_INSTRUCTION
+
+    try:
+        with GEMINI_SEM:
+            response = GEMINI_CLIENT.post(GEMINI_URL, params=GEMINI_PARAMS,
+                                          headers=JSON_HEADERS, content=orjson.dumps(payload))
+        response.raise_for_status()
+        GEMINI_BREAKER.record_success()
+
+        if len(response.content) > GEMINI_MAX_RESPONSE_BYTES:
+            logger.error("Gemini response exceeded size cap: %d bytes", len(response.content))
+            return "Error: Received an oversized response from the Gemini API\\."
+
+        result = orjson.loads(response.content)
+
+        try:
+            candidate = result["candidates"][0]
+            parts = candidate["content"]["parts"]
+            text = parts[0].get("text")
+        except (KeyError, IndexError, TypeError):
+            return "Error: Received an empty or unexpected response from the Gemini API\\."
+
+        if not text:
+            # A non-answer, like the error paths: don't let it into either
+            # cache tier where it would be served for the full TTL.
+            return "Could not generate a textual response\\."
+
+        # Escape the model text before the source links are appended, so the
+        # links themselves stay valid MarkdownV2.
+        text = escape_md_v2(text)
+
+        # Append grounded search sources, deduping by URI *before* any
+        # formatting work (Gemini often cites the same page twice).
+        grounding = candidate.get("groundingMetadata") or {}
+        seen = set()
+        source_lines = []
+        for attr in grounding.get("groundingAttributions", ()):
+            web = attr.get("web")
+            if not web:
+                continue
+            uri = web.get("uri")
+            if not uri or uri in seen:
+                continue
+            seen.add(uri)
+            # Inside a MarkdownV2 link target only ')' and '\' are special.
+            safe_uri = uri.replace("\\", "\\\\").replace(")", "\\)")
+            source_lines.append(f"{len(source_lines) + 1}\\. [{escape_md_v2(web.get('title', 'Link'))}]({safe_uri})")
+            if len(source_lines) == 3:
+                break
+        if source_lines:
+            text += "\n\nSources:\n" + "\n".join(source_lines)
+
+        _cache_put(cache_key, text)
+        SEMANTIC_CACHE.put(query_vec, prompt, text)
+        return text
+
+    except httpx.HTTPStatusError as e:
+        GEMINI_BREAKER.record_failure()
+        logger.error("HTTP Error: %s - %s", e.response.status_code, e.response.text)
+        return f"An HTTP error occurred: {e.response.status_code}\\. Please check the server logs\\."
+    except Exception as e:
+        GEMINI_BREAKER.record_failure()
+        logger.error("General Error generating response: %s", e)
+        return "An unknown error occurred while generating the response\\."
+
+# --- Telegram Helper ---
+
+# All outbound Telegram traffic rides this queue: the single worker gives
+# FIFO delivery, so a reply can never overtake the "Thinking..." notice
+# queued before it. Bounded so a Telegram outage cannot balloon memory.
+OUTBOX = queue.Queue(maxsize=1000)
+
+def _outbox_worker():
+    while True:
+        url, payload = OUTBOX.get()
+        try:
+            TG_SESSION.post(url, json=payload, timeout=5)
+        except Exception as e:
+            logger.error("Outbox send failed: %s", e)
+        finally:
+            OUTBOX.task_done()
+
+threading.Thread(target=_outbox_worker, daemon=True).start()
+
+def _enqueue_outbox(url, payload):
+    try:
+        OUTBOX.put_nowait((url, payload))
+    except queue.Full:
+        logger.error("Telegram outbox full; dropping request for chat %s", payload.get("chat_id"))
+
+def send_telegram_message(chat_id, text, parse_mode="MarkdownV2"):
+    """Queues a message to Telegram without blocking the caller."""
+    _enqueue_outbox(SEND_MESSAGE_URL, {
+        "chat_id": chat_id,
+        "text": text,
+        "parse_mode": parse_mode,
+        "disable_web_page_preview": True
+    })
+
+def send_chat_action(chat_id, action="typing"):
+    """Queues a chat-action indicator; it overlaps whatever the caller does next."""
+    _enqueue_outbox(SEND_CHAT_ACTION_URL, {"chat_id": chat_id, "action": action})
+
+# --- Connection Warm-up ---
+
+def _warm_connections():
+    """Primes DNS and TLS pool entries for both upstreams so the first real update pays no handshake."""
+    global GEMINI_HEALTHY
+    try:
+        TG_SESSION.head(TELEGRAM_API_URL + "getMe", timeout=5)
+    except Exception as e:
+        logger.warning("Telegram warm-up failed: %s", e)
+    try:
+        # Doubles as a key check: a definitive auth rejection disables AI
+        # calls outright; transient failures leave the bot optimistic.
+        response = GEMINI_CLIENT.get(GEMINI_API_BASE, params=GEMINI_PARAMS)
+        if response.status_code in (400, 401, 403):
+            GEMINI_HEALTHY = False
+            logger.error("Gemini key check failed (%s); AI calls disabled", response.status_code)
+    except Exception as e:
+        logger.warning("Gemini warm-up failed: %s", e)
+
+# Kicked off at import so gunicorn workers warm up as they boot.
+threading.Thread(target=_warm_connections, daemon=True).start()
+
+# --- Asynchronous Logic Processor ---
+
+def process_ai_request(chat_id, text, use_cache=True):
+    """Processes the message payload in a separate thread."""
+    try:
+        # 1. Queue the "Thinking..." acknowledgment and a typing indicator;
+        #    both ride the outbox while Gemini runs.
+        send_telegram_message(chat_id, "Thinking\\.\\.\\.")
+        send_chat_action(chat_id)
+
+        # 2. Generate the final response and queue it behind the notice on
+        #    the same FIFO outbox; on a cache hit the two would otherwise
+        #    race and leave "Thinking..." as the last message.
+        response_text = generate_gemini_response(text, use_cache)
+        send_telegram_message(chat_id, response_text)
+
+    except Exception as e:
+        logger.error("Error processing AI request: %s", e)
+
+# --- Flask Webhook Route ---
+
+@app.route('/')
+def hello():
+    # Simple check to confirm service is awake
+    return "Zathura Companion Bot is running."
+
+@app.route('/webhook', methods=['POST'])
+def webhook_handler():
+    try:
+        # Parse the raw body with orjson directly; request.get_json() would
+        # run the stdlib decoder over an intermediate str and cache a copy.
+        update = orjson.loads(request.get_data(cache=False))
+
+        if not update or 'message' not in update:
+            return OK_RESPONSE
+
+        if _is_duplicate_update(update.get('update_id')):
+            return OK_RESPONSE
+
+        message = update['message']
+        chat_id = message['chat']['id']
+        text = message.get('text', '')
+
+        if not text:
+            return OK_RESPONSE
+
+        if text.startswith('/start'):
+            # Queued to the outbox, so the handler acks Telegram immediately.
+            send_telegram_message(chat_id, WELCOME_TEXT)
+            return OK_RESPONSE
+
+        # /nocache <question> forces a fresh Gemini call past both cache tiers.
+        elif text.startswith('/nocache'):
+            prompt = text[len('/nocache'):].strip()
+            if prompt:
+                EXECUTOR.submit(process_ai_request, chat_id, prompt, False)
+            return OK_RESPONSE
+
+        # Text Handling (AI processing handled asynchronously)
+        else:
+            prompt = text.strip()
+            if len(prompt) < 2:
+                send_telegram_message(chat_id, TOO_SHORT_REPLY)
+            elif _GREETING_RE.match(prompt):
+                send_telegram_message(chat_id, GREETING_REPLY)
+            else:
+                if len(prompt) > MAX_PROMPT_CHARS:
+                    prompt = prompt[:MAX_PROMPT_CHARS]
+                # Hand the heavy AI processing to the worker pool immediately.
+                EXECUTOR.submit(process_ai_request, chat_id, prompt)
+
+        return OK_RESPONSE
+
+    except HTTPException:
+        # Let werkzeug render its own responses — notably the 413 raised by
+        # MAX_CONTENT_LENGTH when get_data() reads an oversized body.
+        raise
+    except Exception as e:
+        logger.error("Error receiving webhook: %s", e)
+        return jsonify({'status': 'error'}), 500
+
+# --- Deployment Setup ---
+
+def set_telegram_webhook():
+    """Sets the Telegram webhook URL."""
+    if not WEBHOOK_URL:
+        logger.error("WEBHOOK_URL not set for webhook.")
+        return
+
+    payload = {"url": f"{WEBHOOK_URL}/webhook"}
+
+    response = TG_SESSION.post(SET_WEBHOOK_URL, json=payload)
+    logger.info("SetWebhook response: %s - %s", response.status_code, response.text)
+
+    if response.status_code != 200:
+        logger.error("Failed to set webhook: %s", response.text)
+
+if __name__ == '__main__':
+    # Set the webhook URL when the bot starts
+    set_telegram_webhook()
+    
+    # Render uses the PORT environment variable
+    port = int(os.environ.get('PORT', 5000))
+    app.run(host='0.0.0.0', port=port)